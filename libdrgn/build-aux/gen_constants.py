@@ -1,72 +1,71 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import io
 import re
 import sys
-from typing import NamedTuple, Sequence, TextIO, Tuple
+from typing import Container, NamedTuple, Sequence, TextIO, Tuple
 
 
 class ConstantClass(NamedTuple):
     name: str
     enum_class: str
-    regex: str
+    # Constants in drgn.h beginning with this prefix are members of the class.
+    # The member name is the rest of the constant name...
+    prefix: str
+    # ... prepended with this.
+    name_prefix: str = ""
     constants: Sequence[Tuple[str, str]] = ()
+    exclude: Container[str] = ()
 
 
 CONSTANTS = (
-    ConstantClass("Architecture", "Enum", r"DRGN_ARCH_([a-zA-Z0-9_]+)"),
-    ConstantClass("FindObjectFlags", "Flag", r"DRGN_FIND_OBJECT_([a-zA-Z0-9_]+)"),
+    ConstantClass("Architecture", "Enum", "DRGN_ARCH_"),
+    ConstantClass("FindObjectFlags", "Flag", "DRGN_FIND_OBJECT_"),
     ConstantClass(
         "PlatformFlags",
         "Flag",
-        r"DRGN_PLATFORM_([a-zA-Z0-9_]+)(?<!DRGN_PLATFORM_DEFAULT_FLAGS)",
+        "DRGN_PLATFORM_",
+        exclude={"DRGN_PLATFORM_DEFAULT_FLAGS"},
     ),
-    ConstantClass("PrimitiveType", "Enum", r"DRGN_(C)_TYPE_([a-zA-Z0-9_]+)"),
+    ConstantClass("PrimitiveType", "Enum", "DRGN_C_TYPE_", name_prefix="C_"),
     ConstantClass(
-        "ProgramFlags", "Flag", r"DRGN_PROGRAM_([a-zA-Z0-9_]+)(?<!DRGN_PROGRAM_ENDIAN)"
+        "ProgramFlags", "Flag", "DRGN_PROGRAM_", exclude={"DRGN_PROGRAM_ENDIAN"}
     ),
-    ConstantClass(
-        "Qualifiers", "Flag", r"DRGN_QUALIFIER_([a-zA-Z0-9_]+)", [("NONE", "0")]
-    ),
-    ConstantClass("SymbolBinding", "Enum", r"DRGN_SYMBOL_BINDING_([a-z-A-Z0-9_]+)"),
-    ConstantClass("SymbolKind", "Enum", r"DRGN_SYMBOL_KIND_([a-z-A-Z0-9_]+)"),
-    ConstantClass("TypeKind", "Enum", r"DRGN_TYPE_([a-zA-Z0-9_]+)"),
+    ConstantClass("Qualifiers", "Flag", "DRGN_QUALIFIER_", constants=[("NONE", "0")]),
+    ConstantClass("SymbolBinding", "Enum", "DRGN_SYMBOL_BINDING_"),
+    ConstantClass("SymbolKind", "Enum", "DRGN_SYMBOL_KIND_"),
+    ConstantClass("TypeKind", "Enum", "DRGN_TYPE_"),
 )
 
 
+# Matches every DRGN_* enumerator in drgn.h. These are assigned to classes by
+# prefix so that the header only has to be scanned once.
+CONSTANT_RE = re.compile(r"^\s*(DRGN_[a-zA-Z0-9_]+)\s*[=,]", flags=re.MULTILINE)
+
+
 def gen_constant_class(
-    drgn_h: str, output_file: TextIO, constant_class: ConstantClass
+    output_file: TextIO,
+    constant_class: ConstantClass,
+    constants: Sequence[Tuple[str, str]],
 ) -> None:
-    constants = list(constant_class.constants)
-    constants.extend(
-        ("_".join(groups[1:]), groups[0])
-        for groups in re.findall(
-            r"^\s*(" + constant_class.regex + r")\s*[=,]", drgn_h, flags=re.MULTILINE
-        )
+    # Build the tuple of (name, value) pairs with a single Py_BuildValue()
+    # call.
+    build_format = "(sK)" * len(constants)
+    build_args = "".join(
+        f',\n\t\t\t    "{name}", (unsigned long long){value}'
+        for name, value in constants
     )
     output_file.write(
         f"""
 static int add_{constant_class.name}(PyObject *m, PyObject *enum_module)
 {{
-	PyObject *tmp, *item;
+	PyObject *tmp;
 	int ret = -1;
 
-	tmp = PyList_New({len(constants)});
+	tmp = Py_BuildValue("({build_format})"{build_args});
 	if (!tmp)
 		goto out;
-"""
-    )
-    for i, (name, value) in enumerate(constants):
-        output_file.write(
-            f"""\
-	item = Py_BuildValue("sK", "{name}", (unsigned long long){value});
-	if (!item)
-		goto out;
-	PyList_SET_ITEM(tmp, {i}, item);
-"""
-        )
-    output_file.write(
-        f"""\
 	{constant_class.name}_class = PyObject_CallMethod(enum_module, "{constant_class.enum_class}", "sO", "{constant_class.name}", tmp);
 	if (!{constant_class.name}_class)
 		goto out;
@@ -92,51 +91,66 @@ out:
 
 def gen_constants(input_file: TextIO, output_file: TextIO) -> None:
     drgn_h = input_file.read()
-    output_file.write(
+    buf = io.StringIO()
+    buf.write(
         """\
 /* Generated by libdrgn/build-aux/gen_constants.py. */
 
 #include "drgnpy.h"
+#include "../array.h"
 
 """
     )
     for constant_class in CONSTANTS:
-        output_file.write(f"PyObject *{constant_class.name}_class;\n")
-    for constant_class in CONSTANTS:
-        gen_constant_class(drgn_h, output_file, constant_class)
-    output_file.write(
+        buf.write(f"PyObject *{constant_class.name}_class;\n")
+    class_constants = [list(constant_class.constants) for constant_class in CONSTANTS]
+    for constant in CONSTANT_RE.findall(drgn_h):
+        for constant_class, constants in zip(CONSTANTS, class_constants):
+            if constant.startswith(constant_class.prefix):
+                if constant not in constant_class.exclude:
+                    constants.append(
+                        (
+                            constant_class.name_prefix
+                            + constant[len(constant_class.prefix) :],
+                            constant,
+                        )
+                    )
+                # The class prefixes don't overlap, so no other class can
+                # match.
+                break
+    for constant_class, constants in zip(CONSTANTS, class_constants):
+        gen_constant_class(buf, constant_class, constants)
+    buf.write(
         """
 int add_module_constants(PyObject *m)
 {
+	static int (* const adders[])(PyObject *, PyObject *) = {
+"""
+    )
+    for constant_class in CONSTANTS:
+        buf.write(f"\t\tadd_{constant_class.name},\n")
+    buf.write(
+        """\
+	};
 	PyObject *enum_module;
-	int ret;
+	int ret = 0;
 
 	enum_module = PyImport_ImportModule("enum");
 	if (!enum_module)
 		return -1;
 
-"""
-    )
-    for i, constant_class in enumerate(CONSTANTS):
-        if i == 0:
-            output_file.write("\tif (")
-        else:
-            output_file.write("\t    ")
-        output_file.write(f"add_{constant_class.name}(m, enum_module) == -1")
-        if i == len(CONSTANTS) - 1:
-            output_file.write(")\n")
-        else:
-            output_file.write(" ||\n")
-    output_file.write(
-        """\
-		ret = -1;
-	else
-		ret = 0;
+	for (size_t i = 0; i < array_size(adders); i++) {
+		if (adders[i](m, enum_module) == -1) {
+			ret = -1;
+			break;
+		}
+	}
 	Py_DECREF(enum_module);
 	return ret;
 }
 """
     )
+    output_file.write(buf.getvalue())
 
 
 if __name__ == "__main__":
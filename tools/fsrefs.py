@@ -4,7 +4,7 @@ import argparse
 import os
 import sys
 import typing
-from typing import Any, Callable, Iterator, Optional, Sequence, Union
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from drgn import FaultError, Object, Program, TypeKind, cast, container_of
 from drgn.helpers.linux.cpumask import for_each_possible_cpu
@@ -29,8 +29,15 @@ from drgn.helpers.linux.plist import plist_for_each_entry
 from drgn.helpers.linux.rbtree import rbtree_inorder_for_each_entry
 
 
+def warn_fault(message: str) -> None:
+    print(
+        f"warning: fault while {message}, possibly due to race; results may be incomplete",
+        file=sys.stderr,
+    )
+
+
 class warn_on_fault:
-    def __init__(self, message: Union[str, Callable[[], str]]) -> None:
+    def __init__(self, message: str) -> None:
         self._message = message
 
     def __enter__(self) -> None:
@@ -38,14 +45,8 @@ class warn_on_fault:
 
     def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> bool:
         if exc_type is not None and issubclass(exc_type, FaultError):
-            message = (
-                self._message if isinstance(self._message, str) else self._message()
-            )
-            if message:
-                print(
-                    f"warning: fault while {message}, possibly due to race; results may be incomplete",
-                    file=sys.stderr,
-                )
+            if self._message:
+                warn_fault(self._message)
             return True
         return False
 
@@ -53,10 +54,8 @@ class warn_on_fault:
 ignore_fault = warn_on_fault("")
 
 
-format_args = {
-    "dereference": False,
-    "symbolize": False,
-}
+def format_obj(obj: Object) -> str:
+    return obj.format_(dereference=False, symbolize=False)
 
 
 if typing.TYPE_CHECKING:
@@ -71,40 +70,40 @@ if typing.TYPE_CHECKING:
 
 class InodeVisitor:
     def __init__(self, inode: Object) -> None:
-        self._inode = inode.read_()
+        self._inode_addr = inode.value_()
 
     def visit_file(self, file: Object) -> Optional[str]:
-        if file.f_inode != self._inode:
+        if file.f_inode.value_() != self._inode_addr:
             return None
-        return file.format_(**format_args)
+        return format_obj(file)
 
     def visit_inode(self, inode: Object) -> Optional[str]:
-        if inode != self._inode:
+        if inode.value_() != self._inode_addr:
             return None
-        return inode.format_(**format_args)
+        return format_obj(inode)
 
     def visit_path(self, path: Object) -> Optional[str]:
-        if path.dentry.d_inode != self._inode:
+        if path.dentry.d_inode.value_() != self._inode_addr:
             return None
-        return path.format_(**format_args)
+        return format_obj(path)
 
 
 class SuperBlockVisitor:
     def __init__(self, sb: Object) -> None:
-        self._sb = sb.read_()
+        self._sb_addr = sb.value_()
 
     def visit_file(self, file: Object) -> Optional[str]:
-        if file.f_inode.i_sb != self._sb:
+        if file.f_inode.i_sb.value_() != self._sb_addr:
             return None
-        match = file.format_(**format_args)
+        match = format_obj(file)
         with ignore_fault:
             match += " " + os.fsdecode(d_path(file.f_path))
         return match
 
     def visit_inode(self, inode: Object) -> Optional[str]:
-        if inode.i_sb != self._sb:
+        if inode.i_sb.value_() != self._sb_addr:
             return None
-        match = inode.format_(**format_args)
+        match = format_obj(inode)
         with ignore_fault:
             path = inode_path(inode)
             if path:
@@ -112,9 +111,9 @@ class SuperBlockVisitor:
         return match
 
     def visit_path(self, path: Object) -> Optional[str]:
-        if path.mnt.mnt_sb != self._sb:
+        if path.mnt.mnt_sb.value_() != self._sb_addr:
             return None
-        match = path.format_(**format_args)
+        match = format_obj(path)
         with ignore_fault:
             match += " " + os.fsdecode(d_path(path))
         return match
@@ -165,100 +164,140 @@ def super_block_on_bdev(bdev: Object) -> Optional[Object]:
     return None
 
 
+def task_id(task: Object) -> str:
+    try:
+        return f"pid {task.pid.value_()} ({os.fsdecode(task.comm.string_())})"
+    except FaultError:
+        return "task"
+
+
 def visit_tasks(
     prog: Program, visitor: "Visitor", *, check_mounts: bool, check_tasks: bool
 ) -> None:
     check_mounts = check_mounts and isinstance(visitor, SuperBlockVisitor)
     if check_mounts:
-        init_mnt_ns = prog["init_task"].nsproxy.mnt_ns
+        init_mnt_ns_addr = prog["init_task"].nsproxy.mnt_ns.value_()
         checked_mnt_ns = {0}
+        sb_addr = visitor._sb_addr  # type: ignore [attr-defined]
+    # Most files are shared between many tasks (e.g., mapped libraries), so
+    # only visit each one once.
+    file_matches: Dict[int, Optional[str]] = {}
+
+    def visit_file(file: Object) -> Optional[str]:
+        address = file.value_()
+        try:
+            return file_matches[address]
+        except KeyError:
+            match = file_matches[address] = visitor.visit_file(file)
+            return match
+
+    # Thread group leader address -> (files, fs, mm) addresses.
+    leader_cache: Dict[int, Tuple[int, int, int]] = {}
     with warn_on_fault("iterating tasks"):
         for task in for_each_task(prog):
-            cached_task_id = None
-
-            def task_id() -> str:
-                nonlocal cached_task_id
-                if cached_task_id is None:
-                    pid = task.pid.value_()
-                    comm = os.fsdecode(task.comm.string_())
-                    cached_task_id = f"pid {pid} ({comm})"
-                return cached_task_id
-
-            def task_fault_warning() -> str:
-                try:
-                    return f"checking {task_id()}"
-                except FaultError:
-                    return "checking task"
-
-            with warn_on_fault(task_fault_warning):
-                files: Optional[Object] = task.files.read_()
-                fs: Optional[Object] = task.fs.read_()
-                mm: Optional[Object] = task.mm.read_()
-
-                # If this task is not the thread group leader, don't bother
-                # checking it again unless it has its own context.
-                group_leader = task.group_leader.read_()
-                if task != group_leader:
-                    if files and files == group_leader.files:
-                        files = None
-                    if fs and fs == group_leader.fs:
-                        fs = None
-                    if mm and mm == group_leader.mm:
-                        mm = None
-
+            # Buffer the matches for each task without the task identifier,
+            # which is only computed if there were any matches.
+            output: List[str] = []
+            # This is equivalent to warn_on_fault(), but it avoids creating a
+            # context manager and a closure for every task.
+            try:
                 if check_mounts:
                     nsproxy = task.nsproxy.read_()
                     if nsproxy:
                         mnt_ns = nsproxy.mnt_ns.read_()
-                        if mnt_ns.value_() not in checked_mnt_ns:
-                            for mount in for_each_mount(mnt_ns):
-                                with ignore_fault:
-                                    if mount.mnt.mnt_sb == visitor._sb:  # type: ignore [attr-defined]
-                                        if mnt_ns == init_mnt_ns:
-                                            mnt_ns_note = ""
-                                        else:
-                                            mnt_ns_note = f" (mount namespace {mnt_ns.ns.inum.value_()})"
-                                        print(
-                                            f"mount {os.fsdecode(mount_dst(mount))}{mnt_ns_note} "
-                                            f"{mount.format_(**format_args)}"
-                                        )
-
-                            checked_mnt_ns.add(mnt_ns.value_())
+                        mnt_ns_val = mnt_ns.value_()
+                        if mnt_ns_val not in checked_mnt_ns:
+                            # Don't let a fault in one namespace abort the
+                            # rest of this task's checks.
+                            with warn_on_fault("iterating mounts"):
+                                for mount in for_each_mount(mnt_ns):
+                                    with ignore_fault:
+                                        if mount.mnt.mnt_sb.value_() == sb_addr:
+                                            if mnt_ns_val == init_mnt_ns_addr:
+                                                mnt_ns_note = ""
+                                            else:
+                                                mnt_ns_note = f" (mount namespace {mnt_ns.ns.inum.value_()})"
+                                            print(
+                                                f"mount {os.fsdecode(mount_dst(mount))}{mnt_ns_note} "
+                                                f"{format_obj(mount)}"
+                                            )
+                            checked_mnt_ns.add(mnt_ns_val)
 
                 if check_tasks:
+                    files: Optional[Object] = task.files.read_()
+                    fs: Optional[Object] = task.fs.read_()
+                    mm: Optional[Object] = task.mm.read_()
+
+                    # If this task is not the thread group leader, don't bother
+                    # checking it again unless it has its own context.
+                    group_leader = task.group_leader.read_()
+                    group_leader_addr = group_leader.value_()
+                    if task.value_() != group_leader_addr:
+                        try:
+                            leader_files, leader_fs, leader_mm = leader_cache[
+                                group_leader_addr
+                            ]
+                        except KeyError:
+                            leader_files = group_leader.files.value_()
+                            leader_fs = group_leader.fs.value_()
+                            leader_mm = group_leader.mm.value_()
+                            leader_cache[group_leader_addr] = (
+                                leader_files,
+                                leader_fs,
+                                leader_mm,
+                            )
+                        if files and files.value_() == leader_files:
+                            files = None
+                        if fs and fs.value_() == leader_fs:
+                            fs = None
+                        if mm and mm.value_() == leader_mm:
+                            mm = None
+
                     if files:
+                        # These loops can be very long, so avoid the overhead
+                        # of a context manager per iteration.
                         for fd, file in for_each_file(task):
-                            with ignore_fault:
-                                match = visitor.visit_file(file)
-                                if match:
-                                    print(f"{task_id()} fd {fd} {match}")
+                            try:
+                                match = visit_file(file)
+                            except FaultError:
+                                continue
+                            if match:
+                                output.append(f"fd {fd} {match}")
 
                     if fs:
                         with ignore_fault:
                             match = visitor.visit_path(fs.root.address_of_())
                             if match:
-                                print(f"{task_id()} root {match}")
+                                output.append(f"root {match}")
                         with ignore_fault:
                             match = visitor.visit_path(fs.pwd.address_of_())
                             if match:
-                                print(f"{task_id()} cwd {match}")
+                                output.append(f"cwd {match}")
 
                     if mm:
                         exe_file = mm.exe_file.read_()
                         if exe_file:
-                            match = visitor.visit_file(exe_file)
+                            match = visit_file(exe_file)
                             if match:
-                                print(f"{task_id()} exe {match}")
+                                output.append(f"exe {match}")
 
                         for vma in for_each_vma(mm):
-                            with ignore_fault:
+                            try:
                                 file = vma.vm_file.read_()
-                                if file:
-                                    match = visitor.visit_file(file)
-                                    if match:
-                                        print(
-                                            f"{task_id()} vma {hex(vma.vm_start)}-{hex(vma.vm_end)} {match}"
-                                        )
+                                if not file:
+                                    continue
+                                match = visit_file(file)
+                                if match:
+                                    output.append(
+                                        f"vma {vma.vm_start.value_():#x}-{vma.vm_end.value_():#x} {match}"
+                                    )
+                            except FaultError:
+                                pass
+            except FaultError:
+                warn_fault(f"checking {task_id(task)}")
+            if output:
+                prefix = task_id(task)
+                print("\n".join([f"{prefix} {line}" for line in output]))
 
 
 def visit_binfmt_misc(prog: Program, visitor: "Visitor") -> None:
@@ -297,7 +336,7 @@ def visit_binfmt_misc(prog: Program, visitor: "Visitor") -> None:
                         else:
                             user_ns_note = ""
                         print(
-                            f"binfmt_misc{user_ns_note} {os.fsdecode(node.name.string_())} {node.format_(**format_args)} {match}"
+                            f"binfmt_misc{user_ns_note} {os.fsdecode(node.name.string_())} {format_obj(node)} {match}"
                         )
 
 
@@ -317,7 +356,7 @@ def visit_loop_devices(prog: Program, visitor: "Visitor") -> None:
                 if file:
                     match = visitor.visit_file(file)
                     if match:
-                        print(f"loop device {i} {lo.format_(**format_args)} {match}")
+                        print(f"loop device {i} {format_obj(lo)} {match}")
 
 
 def visit_swap_files(prog: Program, visitor: "Visitor") -> None:
@@ -333,7 +372,7 @@ def visit_swap_files(prog: Program, visitor: "Visitor") -> None:
             with ignore_fault:
                 match = visitor.visit_file(swap_info.swap_file)
                 if match:
-                    print(f"swap file {swap_info.format_(**format_args)} {match}")
+                    print(f"swap file {format_obj(swap_info)} {match}")
 
 
 # call was moved from struct trace_probe to struct trace_event Linux kernel
@@ -456,30 +495,26 @@ def visit_uprobes(prog: Program, visitor: "Visitor") -> None:
                                                     owner.comm.string_()
                                                 )
                                                 print(
-                                                    f"perf uprobe (owned by pid {owner_pid} ({owner_comm})) {perf_event.format_(**format_args)} {match}"
+                                                    f"perf uprobe (owned by pid {owner_pid} ({owner_comm})) {format_obj(perf_event)} {match}"
                                                 )
                                             else:
                                                 print(
-                                                    f"perf uprobe (no owner) {perf_event.format_(**format_args)} {match}"
+                                                    f"perf uprobe (no owner) {format_obj(perf_event)} {match}"
                                                 )
                                             found_perf_event = True
                             if not found_perf_event:
-                                print(
-                                    f"unknown trace uprobe {tu.format_(**format_args)} {match}"
-                                )
+                                print(f"unknown trace uprobe {format_obj(tu)} {match}")
                         else:
                             c = "r" if tu.consumer.ret_handler else "p"
                             group_name = trace_probe_group_name(tu.tp)
                             event_name = trace_probe_name(tu.tp)
                             print(
-                                f"uprobe event {c}:{group_name}/{event_name} {tu.format_(**format_args)} {match}"
+                                f"uprobe event {c}:{group_name}/{event_name} {format_obj(tu)} {match}"
                             )
                     else:
-                        print(
-                            f"unknown uprobe consumer {consumer.format_(**format_args)}"
-                        )
+                        print(f"unknown uprobe consumer {format_obj(consumer)}")
             if not found_consumer:
-                print(f"unknown uprobe {uprobe.format_(**format_args)} {match}")
+                print(f"unknown uprobe {format_obj(uprobe)} {match}")
 
 
 def hexint(x: str) -> int:
@@ -601,20 +636,13 @@ def main(prog: Program, argv: Sequence[str]) -> None:
     else:
         assert False
 
-    if args.check:
-        enabled_checks = set(args.check)
-    else:
-        enabled_checks = set(CHECKS)
-        if args.no_check:
-            enabled_checks -= set(args.no_check)
-
-    if "mounts" in enabled_checks or "tasks" in enabled_checks:
-        visit_tasks(
-            prog,
-            visitor,
-            check_mounts="mounts" in enabled_checks,
-            check_tasks="tasks" in enabled_checks,
-        )
+    # --check and --no-check are mutually exclusive.
+    enabled_checks = set(args.check or CHECKS).difference(args.no_check or ())
+
+    check_mounts = "mounts" in enabled_checks
+    check_tasks = "tasks" in enabled_checks
+    if check_mounts or check_tasks:
+        visit_tasks(prog, visitor, check_mounts=check_mounts, check_tasks=check_tasks)
 
     if "binfmt_misc" in enabled_checks:
         visit_binfmt_misc(prog, visitor)